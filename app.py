@@ -1,6 +1,13 @@
+import math
+import re
+import time
+import unicodedata
+from collections import Counter, defaultdict
+
 import pandas as pd
-from flask import Flask, render_template, request
-from sqlalchemy import create_engine, Column, Integer, String, text
+from flask import Flask, jsonify, render_template, request
+from sqlalchemy import create_engine, Column, Index, Integer, String, Text, text
+from sqlalchemy.dialects.postgresql import ARRAY
 from sqlalchemy.orm import declarative_base, sessionmaker
 from pgvector.sqlalchemy import Vector
 from sentence_transformers import SentenceTransformer
@@ -15,6 +22,10 @@ engine = create_engine(DATABASE_URL)
 Base = declarative_base()
 EMBEDDING_DIM = 384
 RESET_DB = True
+TOP_K_SKILLS = 6
+TOP_K_OCCS = 3
+CANDIDATOS_FUSAO = 30  # tamanho de cada lista (léxica e vetorial) antes da fusão
+RRF_K = 60             # constante padrão do Reciprocal Rank Fusion
 
 print("--- CARREGANDO CÉREBRO DA IA ---")
 model = SentenceTransformer('paraphrase-multilingual-MiniLM-L12-v2', device='cpu')
@@ -54,20 +65,48 @@ class EscoSkill(Base):
     uri = Column(String(500), unique=True)
     termo = Column(String(500))
     parent_uri = Column(String(500))
+    alt_labels = Column(Text)  # sinônimos do ESCO, um por linha
+    ancestrais = Column(ARRAY(Text))  # todos os grupos acima desta skill (caminho materializado)
     embedding = Column(Vector(EMBEDDING_DIM))
+    # GIN permite filtrar "qualquer ancestral = X" dentro da própria busca vetorial
+    __table_args__ = (Index('ix_esco_skills_ancestrais', 'ancestrais', postgresql_using='gin'),)
 
 class EscoOccupation(Base):
     __tablename__ = 'esco_occupations'
     id = Column(Integer, primary_key=True)
     termo = Column(String(500), unique=True)
     isco_code = Column(String(10)) 
+    alt_labels = Column(Text)
+    ancestrais = Column(ARRAY(Text))  # prefixos ISCO: ['7', '72', '723', '7233']
     embedding = Column(Vector(EMBEDDING_DIM))
+    __table_args__ = (Index('ix_esco_occupations_ancestrais', 'ancestrais', postgresql_using='gin'),)
 
 class IscoGroup(Base):
     __tablename__ = 'isco_groups'
     code = Column(String(10), primary_key=True)
     label = Column(String(500))
 
+# --- CAMINHOS MATERIALIZADOS ---
+def calcular_ancestrais(uri, pais_dict):
+    """Sobe todas as relações 'broader' (uma skill pode ter mais de um pai) e devolve os ancestrais."""
+    ancestrais = []
+    vistos = {uri}
+    fila = list(pais_dict.get(uri, []))
+    while fila:
+        atual = fila.pop(0)
+        if atual in vistos:
+            continue
+        vistos.add(atual)
+        ancestrais.append(atual)
+        fila.extend(pais_dict.get(atual, []))
+    return ancestrais
+
+def prefixos_isco(isco_code):
+    """'7233' -> ['7', '72', '723', '7233']. Código ausente ('0000') não entra em nenhum grupo."""
+    if not isco_code or len(isco_code) < 4 or isco_code == "0000":
+        return []
+    return [isco_code[:1], isco_code[:2], isco_code[:3], isco_code]
+
 # --- INGESTÃO DE DADOS ---
 def ingest_data():
     if RESET_DB:
@@ -86,8 +125,8 @@ def ingest_data():
     if session.query(IscoGroup).count() == 0:
         print("Ingerindo ISCO Groups...")
         try:
-            df = pd.read_csv('ISCOGroups_en.csv')
-            df['code'] = df['code'].astype(str)
+            # dtype=str preserva zeros à esquerda ('01', '0110')
+            df = pd.read_csv('ISCOGroups_en.csv', dtype={'code': str})
             df = df.drop_duplicates(subset=['code'], keep='last')
             for _, row in df.iterrows():
                 session.add(IscoGroup(code=str(row['code']), label=row['preferredLabel']))
@@ -97,8 +136,10 @@ def ingest_data():
     # 2. Carregar Mapa de Relações de Skills (Pai e Filho)
     print("Carregando Mapa de Relações...")
     rel_dict = {}
+    pais_dict = {}
     try:
         df_rel = pd.read_csv('broaderRelationsSkillPillar_en.csv', usecols=['conceptUri', 'broaderUri'])
+        pais_dict = df_rel.groupby('conceptUri')['broaderUri'].apply(list).to_dict()
         df_rel = df_rel.drop_duplicates(subset=['conceptUri'], keep='first')
         rel_dict = pd.Series(df_rel.broaderUri.values, index=df_rel.conceptUri).to_dict()
     except Exception as e:
@@ -122,21 +163,24 @@ def ingest_data():
     if session.query(EscoSkill).count() == 0:
         print("Ingerindo Skills...")
         try:
-            df_en = pd.read_csv('skills_en.csv', usecols=['conceptUri', 'preferredLabel'])
+            df_en = pd.read_csv('skills_en.csv', usecols=['conceptUri', 'preferredLabel', 'altLabels'])
             df_en = df_en.drop_duplicates(subset=['preferredLabel'])
             
             termos = df_en['preferredLabel'].tolist()
             uris = df_en['conceptUri'].tolist()
+            alts = [a if isinstance(a, str) else None for a in df_en['altLabels'].tolist()]
             
             for i in range(0, len(termos), 64):
                 batch_termos = termos[i:i+64]
                 batch_uris = uris[i:i+64]
+                batch_alts = alts[i:i+64]
                 vetores = model.encode(batch_termos)
                 
                 objs = []
-                for termo, uri, vetor in zip(batch_termos, batch_uris, vetores):
+                for termo, uri, alt, vetor in zip(batch_termos, batch_uris, batch_alts, vetores):
                     parent = rel_dict.get(uri) 
-                    objs.append(EscoSkill(uri=uri, termo=termo, parent_uri=parent, embedding=vetor.tolist()))
+                    objs.append(EscoSkill(uri=uri, termo=termo, parent_uri=parent, alt_labels=alt,
+                                          ancestrais=calcular_ancestrais(uri, pais_dict), embedding=vetor.tolist()))
                 session.add_all(objs)
                 session.commit()
                 print(f"Skills: {i}/{len(termos)}", end='\r')
@@ -146,10 +190,11 @@ def ingest_data():
     if session.query(EscoOccupation).count() == 0:
         print("\nIngerindo Occupations...")
         try:
-            df_occ = pd.read_csv('occupations_en.csv', usecols=['preferredLabel', 'iscoGroup'])
+            df_occ = pd.read_csv('occupations_en.csv', usecols=['preferredLabel', 'iscoGroup', 'altLabels'], dtype={'iscoGroup': str})
             df_occ = df_occ.drop_duplicates(subset=['preferredLabel'])
             termos = df_occ['preferredLabel'].dropna().tolist()
             termo_to_isco = pd.Series(df_occ.iscoGroup.values, index=df_occ.preferredLabel).to_dict()
+            termo_to_alt = pd.Series(df_occ.altLabels.values, index=df_occ.preferredLabel).to_dict()
             
             for i in range(0, len(termos), 64):
                 batch = termos[i:i+64]
@@ -158,7 +203,10 @@ def ingest_data():
                 for t, v in zip(batch, vetores):
                     code = str(termo_to_isco.get(t, "0000"))
                     if code.lower() == 'nan': code = "0000"
-                    objs.append(EscoOccupation(termo=t, isco_code=code, embedding=v.tolist()))
+                    alt = termo_to_alt.get(t)
+                    if not isinstance(alt, str): alt = None
+                    objs.append(EscoOccupation(termo=t, isco_code=code, alt_labels=alt,
+                                               ancestrais=prefixos_isco(code), embedding=v.tolist()))
                 session.add_all(objs)
                 session.commit()
                 print(f"Occs: {i}/{len(termos)}", end='\r')
@@ -193,23 +241,244 @@ def get_isco_hierarchy(session, isco_code):
     group_map = {g.code: g.label for g in groups}
     return [group_map.get(c, c) for c in codes]
 
+# --- ÍNDICE LÉXICO (ATALHO EXATO + FUSÃO HÍBRIDA) ---
+# Índice invertido em memória sobre termo + alt labels. Quando a busca já é um rótulo
+# do ESCO, pulamos o encoder e reaproveitamos o embedding salvo no banco.
+INDICE_LEXICO = {}
+METRICAS_BUSCA = {
+    "buscas": 0,
+    "atalhos_exatos": 0,
+    "acertos_lexicos": 0,
+    "encodes": 0,
+    "tempo_encode_total": 0.0,
+    "tempo_atalho_total": 0.0,  # busca no índice + leitura do embedding salvo
+    "tempo_hibrido_total": 0.0, # custo extra da fusão: BM25 + RRF + segunda consulta ao banco
+}
+TIPOS_LEXICOS = (('skills', EscoSkill), ('occupations', EscoOccupation))
+
+def tokenizar(texto):
+    """Minúsculas, sem acentos e sem pontuação: 'Python (computer programming)' -> ['python', 'computer', 'programming']."""
+    if not texto:
+        return []
+    texto = unicodedata.normalize('NFKD', texto)
+    texto = ''.join(c for c in texto if not unicodedata.combining(c))
+    return re.findall(r'\w+', texto.lower())
+
+def chave_exata(texto):
+    """Minúsculas e espaços colapsados, mantendo símbolos: 'C++', 'C#' e 'C' continuam distintos."""
+    return ' '.join((texto or '').lower().split())
+
+def chave_quase_exata(texto):
+    """Conjunto de tokens (ignora ordem e pontuação); só para rótulos com mais de um token."""
+    tokens = set(tokenizar(texto))
+    return ' '.join(sorted(tokens)) if len(tokens) > 1 else ''
+
+def chaves_sem_ambiguidade(pares):
+    """Mantém só as chaves que apontam para um único conceito; as ambíguas seguem pelo encoder."""
+    donos = defaultdict(set)
+    for chave, doc_id in pares:
+        if chave:
+            donos[chave].add(doc_id)
+    return {chave: ids.pop() for chave, ids in donos.items() if len(ids) == 1}
+
+def construir_indice_lexico():
+    """Monta o índice invertido (BM25) de skills e occupations a partir do banco."""
+    Session = sessionmaker(bind=engine)
+    session = Session()
+    novo_indice = {}
+    for tipo, modelo in TIPOS_LEXICOS:
+        rows = session.query(modelo.id, modelo.termo, modelo.alt_labels, modelo.ancestrais).all()
+        preferidos, sinonimos, postings, tamanhos = [], [], defaultdict(dict), {}
+        ancestrais = {doc_id: set(anc or []) for doc_id, _, _, anc in rows}
+
+        for doc_id, termo, alts, _ in rows:
+            preferidos.append((termo, doc_id))
+            tokens = tokenizar(termo)
+            for alt in (alts or '').split('\n'):
+                if alt.strip():
+                    sinonimos.append((alt, doc_id))
+                tokens += tokenizar(alt)
+            for token, tf in Counter(tokens).items():
+                postings[token][doc_id] = tf
+            tamanhos[doc_id] = len(tokens)
+
+        # Três camadas, em ordem de prioridade: rótulo preferido (só disputa com outros
+        # preferidos), sinônimo exato e conjunto de tokens (ambos descartados se ambíguos)
+        rotulos = preferidos + sinonimos
+        novo_indice[tipo] = {
+            "preferido": chaves_sem_ambiguidade((chave_exata(r), i) for r, i in preferidos),
+            "exato": chaves_sem_ambiguidade((chave_exata(r), i) for r, i in rotulos),
+            "quase_exato": chaves_sem_ambiguidade((chave_quase_exata(r), i) for r, i in rotulos),
+            "postings": postings,
+            "tamanhos": tamanhos,
+            "ancestrais": ancestrais,
+            "tamanho_medio": (sum(tamanhos.values()) / len(tamanhos)) if tamanhos else 0.0,
+        }
+        print(f"Índice léxico ({tipo}): {len(rows)} conceitos, {len(postings)} tokens")
+    session.close()
+    # Troca de uma vez só para que outra requisição nunca veja o índice pela metade
+    INDICE_LEXICO.update(novo_indice)
+
+def carregar_indice_lexico():
+    """Constrói o índice na primeira busca (vale também para `flask run` e servidores WSGI).
+    Se algum tipo ficou vazio (banco ainda sendo ingerido), reconstrói assim que houver linhas."""
+    vazios = [modelo for tipo, modelo in TIPOS_LEXICOS if not INDICE_LEXICO.get(tipo, {}).get("tamanhos")]
+    if vazios:
+        Session = sessionmaker(bind=engine)
+        session = Session()
+        tem_linhas = any(session.query(modelo.id).first() is not None for modelo in vazios)
+        session.close()
+        if tem_linhas:
+            construir_indice_lexico()
+    return INDICE_LEXICO
+
+def buscar_exato(tipo, texto):
+    """Retorna o id do conceito cujo rótulo (ou sinônimo) é exatamente/quase exatamente o texto."""
+    indice = INDICE_LEXICO.get(tipo)
+    if not indice:
+        return None
+    chave = chave_exata(texto)
+    acerto = indice["preferido"].get(chave)
+    if acerto is None:
+        acerto = indice["exato"].get(chave)
+    if acerto is None:
+        acerto = indice["quase_exato"].get(chave_quase_exata(texto))
+    return acerto
+
+def no_escopo(tipo, doc_id, escopo):
+    """True se o conceito está sob o ancestral `escopo` (sem escopo, tudo vale)."""
+    return not escopo or escopo in INDICE_LEXICO[tipo]["ancestrais"].get(doc_id, ())
+
+def buscar_lexico(tipo, texto, escopo=None, limite=CANDIDATOS_FUSAO, k1=1.2, b=0.75):
+    """Ranqueia os conceitos por BM25 sobre termo + alt labels, opcionalmente só dentro de uma subárvore."""
+    indice = INDICE_LEXICO.get(tipo)
+    if not indice or not indice["tamanhos"]:
+        return []
+    n_docs = len(indice["tamanhos"])
+    scores = defaultdict(float)
+    for token in set(tokenizar(texto)):
+        docs = indice["postings"].get(token)
+        if not docs:
+            continue
+        idf = math.log(1 + (n_docs - len(docs) + 0.5) / (len(docs) + 0.5))
+        for doc_id, tf in docs.items():
+            if escopo and escopo not in indice["ancestrais"].get(doc_id, ()):
+                continue
+            norm = k1 * (1 - b + b * indice["tamanhos"][doc_id] / indice["tamanho_medio"])
+            scores[doc_id] += idf * tf * (k1 + 1) / (tf + norm)
+    return [doc_id for doc_id, _ in sorted(scores.items(), key=lambda x: -x[1])[:limite]]
+
+def fundir_rrf(listas, k=RRF_K):
+    """Reciprocal Rank Fusion: soma 1/(k + posição) de cada lista de ids."""
+    scores = defaultdict(float)
+    for lista in listas:
+        for pos, doc_id in enumerate(lista, start=1):
+            scores[doc_id] += 1.0 / (k + pos)
+    return [doc_id for doc_id, _ in sorted(scores.items(), key=lambda x: -x[1])]
+
+def buscar_hibrido(session, modelo, tipo, vetor, texto, top_k, escopo=None):
+    """Funde candidatos vetoriais e léxicos; um acerto exato sempre fica em primeiro lugar.
+    Com `escopo`, o filtro de ancestral roda dentro do próprio SQL (índice GIN), então o top-k
+    já vem completo da subárvore, sem buscar a mais e filtrar em Python.
+    Retorna [(obj, dist), ...] e se houve acerto léxico: um acerto exato/quase exato ou algum
+    resultado exibido que só o índice léxico encontrou (não estava na lista vetorial)."""
+    dist = modelo.embedding.cosine_distance(vetor).label("dist")
+    q_vetor = session.query(modelo.id)
+    if escopo:
+        q_vetor = q_vetor.filter(modelo.ancestrais.contains([escopo]))
+    ids_vetor = [i for (i,) in q_vetor.order_by(dist).limit(CANDIDATOS_FUSAO)]
+
+    # Daqui em diante é o que a busca híbrida custa a mais que a vetorial pura
+    inicio = time.perf_counter()
+    ids_lexico = buscar_lexico(tipo, texto, escopo)
+
+    ids = fundir_rrf([ids_vetor, ids_lexico])
+    acerto = buscar_exato(tipo, texto)
+    if acerto is not None and not no_escopo(tipo, acerto, escopo):
+        acerto = None
+    if acerto is not None:
+        ids = [acerto] + [i for i in ids if i != acerto]
+    ids = ids[:top_k]
+
+    rows = session.query(modelo, dist).filter(modelo.id.in_(ids)).all()
+    por_id = {obj.id: (obj, d) for obj, d in rows}
+    METRICAS_BUSCA["tempo_hibrido_total"] += time.perf_counter() - inicio
+    so_lexico = set(ids_lexico) - set(ids_vetor)
+    usou_lexico = acerto is not None or any(i in so_lexico for i in ids)
+    return [por_id[i] for i in ids if i in por_id], usou_lexico
+
+# --- OPÇÕES DE ESCOPO (FILTRO POR SUBÁRVORE) ---
+CACHE_ESCOPOS = {}
+
+def carregar_escopos():
+    """Lista os ramos de skills (até 3 níveis) e os grandes grupos/subgrupos ISCO para o formulário."""
+    if CACHE_ESCOPOS.get("skills") and CACHE_ESCOPOS.get("isco"):
+        return CACHE_ESCOPOS
+    Session = sessionmaker(bind=engine)
+    session = Session()
+
+    grupos = {g.uri: g for g in session.query(EscoSkillGroup).all()}
+    skills = []
+    for g in grupos.values():
+        # Profundidade e ordem pela cadeia de pai único (parent_uri); `ancestrais` serve só ao filtro
+        caminho = [g.termo]
+        atual = grupos.get(g.parent_uri)
+        while atual is not None and len(caminho) < 10:
+            caminho.insert(0, atual.termo)
+            atual = grupos.get(atual.parent_uri)
+        if len(caminho) <= 3:
+            skills.append({"valor": g.uri, "termo": g.termo, "nivel": len(caminho) - 1, "ordem": tuple(caminho)})
+    skills.sort(key=lambda x: x["ordem"])
+
+    isco = [{"valor": g.code, "termo": f"{g.code} - {g.label}", "nivel": len(g.code) - 1}
+            for g in session.query(IscoGroup).order_by(IscoGroup.code).all() if len(g.code) <= 2]
+    session.close()
+
+    novos = {"skills": skills, "isco": isco}
+    # Troca de uma vez só, e lista vazia (banco ainda sem dados) não fica presa no cache
+    if skills and isco:
+        CACHE_ESCOPOS.update(novos)
+    return novos
+
 # --- ROTA PRINCIPAL ---
 @app.route('/', methods=['GET', 'POST'])
 def index():
     data = {"skills": [], "occupations": []}
     texto_busca = ""
     zoom_level = request.form.get('zoom_level', 'micro') 
+    # Vazio = busca em toda a base; senão, URI de um grupo de skills ou prefixo ISCO
+    escopo_skill = request.form.get('escopo_skill', '')
+    escopo_isco = request.form.get('escopo_isco', '')
     
     if request.method == 'POST':
         texto_busca = request.form.get('skill_desc')
         if texto_busca:
             Session = sessionmaker(bind=engine)
             session = Session()
-            vetor = model.encode(texto_busca).tolist()
+            carregar_indice_lexico()
+            METRICAS_BUSCA["buscas"] += 1
+
+            # Atalho: se a busca já é um rótulo do ESCO, reaproveita o embedding salvo.
+            # Os dois caminhos são cronometrados do mesmo ponto (incluindo a busca no índice).
+            inicio = time.perf_counter()
+            acerto_skill = buscar_exato('skills', texto_busca)
+            acerto_occ = buscar_exato('occupations', texto_busca)
+            if acerto_skill is not None:
+                vetor = session.get(EscoSkill, acerto_skill).embedding.tolist()
+            elif acerto_occ is not None:
+                vetor = session.get(EscoOccupation, acerto_occ).embedding.tolist()
+            else:
+                vetor = model.encode(texto_busca).tolist()
+            decorrido = time.perf_counter() - inicio
+            if acerto_skill is not None or acerto_occ is not None:
+                METRICAS_BUSCA["atalhos_exatos"] += 1
+                METRICAS_BUSCA["tempo_atalho_total"] += decorrido
+            else:
+                METRICAS_BUSCA["encodes"] += 1
+                METRICAS_BUSCA["tempo_encode_total"] += decorrido
             
             # --- 1. SKILLS ---
-            dist_skill = EscoSkill.embedding.cosine_distance(vetor).label("dist")
-            q_skills = session.query(EscoSkill, dist_skill).order_by(dist_skill).limit(6).all()
+            q_skills, lex_skills = buscar_hibrido(session, EscoSkill, 'skills', vetor, texto_busca, TOP_K_SKILLS, escopo_skill)
             for s, d in q_skills:
                 score = (1 - d) * 100
                 hierarchy = get_skill_hierarchy(session, s.parent_uri)
@@ -238,8 +507,9 @@ def index():
                 })
 
             # --- 2. OCCUPATIONS ---
-            dist_occ = EscoOccupation.embedding.cosine_distance(vetor).label("dist")
-            q_occs = session.query(EscoOccupation, dist_occ).order_by(dist_occ).limit(3).all()
+            q_occs, lex_occs = buscar_hibrido(session, EscoOccupation, 'occupations', vetor, texto_busca, TOP_K_OCCS, escopo_isco)
+            if lex_skills or lex_occs:
+                METRICAS_BUSCA["acertos_lexicos"] += 1
             for o, d in q_occs:
                 score = (1 - d) * 100
                 hierarchy = get_isco_hierarchy(session, o.isco_code)
@@ -267,8 +537,35 @@ def index():
                 })
             session.close()
 
-    return render_template('index.html', data=data, busca_anterior=texto_busca, zoom_level=zoom_level)
+    return render_template('index.html', data=data, busca_anterior=texto_busca, zoom_level=zoom_level,
+                           escopos=carregar_escopos(), escopo_skill=escopo_skill, escopo_isco=escopo_isco)
+
+# --- MÉTRICAS DA BUSCA HÍBRIDA ---
+@app.route('/metricas')
+def metricas():
+    m = METRICAS_BUSCA
+    buscas = m["buscas"] or 1
+    encode_medio = (m["tempo_encode_total"] / m["encodes"]) if m["encodes"] else None
+    atalho_medio = (m["tempo_atalho_total"] / m["atalhos_exatos"]) if m["atalhos_exatos"] else None
+    # Economia medida: (encode médio - atalho médio) por atalho. Sem os dois lados medidos, fica nulo.
+    economizado = None
+    if encode_medio is not None and atalho_medio is not None:
+        economizado = round(m["atalhos_exatos"] * (encode_medio - atalho_medio) * 1000, 2)
+    # O outro lado da conta: BM25 + fusão + consulta extra que toda busca paga
+    custo_hibrido = round(m["tempo_hibrido_total"] * 1000, 2)
+    return jsonify({
+        "buscas": m["buscas"],
+        "taxa_acerto_lexico": round(m["acertos_lexicos"] / buscas, 3),
+        "taxa_atalho_exato": round(m["atalhos_exatos"] / buscas, 3),
+        "encode_medio_ms": round(encode_medio * 1000, 2) if encode_medio is not None else None,
+        "atalho_medio_ms": round(atalho_medio * 1000, 2) if atalho_medio is not None else None,
+        "tempo_economizado_ms": economizado,
+        "hibrido_medio_ms": round(m["tempo_hibrido_total"] / m["buscas"] * 1000, 2) if m["buscas"] else None,
+        "custo_hibrido_ms": custo_hibrido,
+        "saldo_ms": round(economizado - custo_hibrido, 2) if economizado is not None else None,
+    })
 
 if __name__ == '__main__':
     ingest_data() 
+    construir_indice_lexico()
     app.run(debug=True, port=5000)
\ No newline at end of file